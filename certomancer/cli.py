@@ -341,6 +341,7 @@ def animate(ctx, port, no_web_ui, no_time_override, wsgi_prefix):
         AnimatorArchStore(cfg.pki_archs), with_web_ui=not no_web_ui,
         allow_time_override=not no_time_override
     )
+    app.warm_up()
     if wsgi_prefix:
         # Serve the Animator under the indicated prefix, wrapped using
         # dispatcher middleware (functionally equivalent to SCRIPT_NAME, but
@@ -1,17 +1,23 @@
+import base64
+import binascii
+import functools
+import hashlib
+import itertools
 import logging
 import os
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from datetime import datetime
 from io import BytesIO
-from typing import Optional, Dict, List, Callable
+from typing import Optional, Dict, List, Callable, Tuple, Any, NamedTuple, \
+    FrozenSet
 
 import tzlocal
 from asn1crypto import ocsp, tsp, pem
 from werkzeug.wrappers import Request, Response
 from dateutil.parser import parse as parse_dt
-from werkzeug.routing import Map, Rule, BaseConverter, Submount
 from werkzeug.exceptions import HTTPException, NotFound, InternalServerError, \
-    BadRequest
+    BadRequest, MethodNotAllowed, RequestEntityTooLarge
 
 from certomancer.config_utils import ConfigurationError
 from certomancer.crypto_utils import pyca_cryptography_present
@@ -29,27 +35,60 @@ logger = logging.getLogger(__name__)
 pfx_possible = pyca_cryptography_present()
 
 
-def _now():
-    return datetime.now(tz=tzlocal.get_localzone())
+FAKE_TIME_HEADER = 'X-Certomancer-Fake-Time'
 
+# OCSP and TSA requests are typically well under a kilobyte, but signed
+# OCSP requests can include a certificate chain
+DEFAULT_MAX_REQUEST_SIZE = 64 * 1024
 
-FAKE_TIME_HEADER = 'X-Certomancer-Fake-Time'
+# Every worker process keeps its own cache, so this bounds the memory
+# footprint per worker (in bytes of encoded responses)
+DEFAULT_RESPONSE_CACHE_SIZE = 16 * 1024 * 1024
 
 
-class PemExtensionConverter(BaseConverter):
+class _ResponseCache:
+    """
+    LRU cache for encoded service responses, bounded by the total size
+    of the values it holds (as reported by the ``size`` callback), in bytes.
 
-    def __init__(self, map, exts=('crt', 'cert', 'cer')):
-        if isinstance(exts, str):
-            exts = (exts,)
-        self.expected_exts = exts
-        self.regex = r"(%s)(\.pem)?" % '|'.join(exts)
-        super().__init__(map)
+    Only responses that are fully determined by the cache key should be
+    stored here.
+    """
 
-    def to_python(self, value):
-        return value.endswith('.pem')
+    def __init__(self, maxsize=DEFAULT_RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        # key -> (value, size)
+        self._entries = OrderedDict()
+        self._total_size = 0
 
-    def to_url(self, value):
-        return self.expected_exts[0] + ('.pem' if value else '')
+    def get(self, key):
+        try:
+            value, _ = self._entries[key]
+        except KeyError:
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def get_or_compute(self, key, compute: Callable[[], Any],
+                       size: Callable[[Any], int] = len):
+        entries = self._entries
+        try:
+            value, _ = entries[key]
+            entries.move_to_end(key)
+            return value
+        except KeyError:
+            pass
+        value = compute()
+        value_size = size(value)
+        if value_size > self.maxsize:
+            # also covers the case where caching is disabled
+            return value
+        entries[key] = value, value_size
+        self._total_size += value_size
+        while self._total_size > self.maxsize:
+            _, (_, evicted_size) = entries.popitem(last=False)
+            self._total_size -= evicted_size
+        return value
 
 
 @dataclass(frozen=True)
@@ -125,78 +164,321 @@ class ArchServicesDescription:
 WEB_UI_URL_PREFIX = '_certomancer'
 
 
-def web_ui_rules():
-    return [
-        Rule('/', endpoint='index', methods=('GET',)),
-        Submount("/" + WEB_UI_URL_PREFIX, [
-            # convenience endpoint that serves certs without regard for
-            # checking whether they belong to any particular (logical)
-            # cert repo (these URLs aren't part of the "PKI API", for lack
-            # of a better term)
-            Rule('/any-cert/<arch>/<label>.<ext:use_pem>',
-                 endpoint='any-cert', methods=('GET',)),
-            Rule('/any-attr-cert/<arch>/<label>.attr.<ext:use_pem>',
-                 endpoint='any-attr-cert', methods=('GET',)),
-            Rule('/attr-certs-of/<arch>/<entity_label>-all.attr.cert.pem',
-                 endpoint='attr-certs-of', methods=('GET',)),
-            Rule('/cert-bundle/<arch>', endpoint='cert-bundle',
-                 methods=('GET',)),
-            Rule('/pfx-download/<arch>', endpoint='pfx-download',
-                 methods=('POST',)),
-        ])
-    ]
+_CERT_EXTS = ('crt', 'cert', 'cer')
+
+
+class _RouteTarget(NamedTuple):
+    # a plain tuple, so unpacking it on the hot path is cheap
+    endpoint: str
+    methods: FrozenSet[str]
+    defaults: Tuple[Tuple[str, Any], ...] = ()
+
+
+@dataclass(frozen=True)
+class _FileName:
+    """
+    Pattern for the last segment of a URL, of the form
+    ``<prefix><param><suffix>.<ext>[.pem]``.
+
+    If ``exts`` is empty, the segment must end in ``suffix`` and no
+    ``use_pem`` value is produced.
+    """
+
+    prefix: str
+    param: Optional[str] = None
+    suffix: str = ''
+    exts: Tuple[str, ...] = _CERT_EXTS
+    int_param: bool = False
+    _suffixes: Tuple[Tuple[str, Optional[bool]], ...] = field(
+        init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        if not self.exts:
+            suffixes = [(self.suffix, None)]
+        else:
+            suffixes = []
+            for ext in self.exts:
+                suffixes.append((f"{self.suffix}.{ext}.pem", True))
+                suffixes.append((f"{self.suffix}.{ext}", False))
+            # try longer suffixes first, so 'x.crt.pem' isn't read as
+            # 'x.crt' with a bogus '.pem' extension
+            suffixes.sort(key=lambda x: len(x[0]), reverse=True)
+        object.__setattr__(self, '_suffixes', tuple(suffixes))
+
+    def match(self, segment: str) -> Optional[dict]:
+        if not segment.startswith(self.prefix):
+            return None
+        rest = segment[len(self.prefix):]
+        for suffix, use_pem in self._suffixes:
+            if not rest.endswith(suffix):
+                continue
+            value = rest[:len(rest) - len(suffix)]
+            values = {} if use_pem is None else {'use_pem': use_pem}
+            if self.param is None:
+                if value:
+                    continue
+            elif not value:
+                continue
+            elif self.int_param:
+                if not (value.isascii() and value.isdigit()):
+                    continue
+                values[self.param] = int(value)
+            else:
+                values[self.param] = value
+            return values
+        return None
 
 
-def service_rules():
+@dataclass(frozen=True)
+class _Remainder:
+    """
+    Pattern that captures the (nonempty) remainder of a URL, including
+    any slashes.
+    """
+
+    param: str
+
+
+# Sentinel keys in the routing trie
+_PARAM = object()
+_FILES = object()
+_REST = object()
+_TARGET = object()
+
+
+def _get(endpoint, **defaults):
+    return _RouteTarget(
+        endpoint, methods=frozenset(('GET', 'HEAD')),
+        defaults=tuple(defaults.items())
+    )
+
+
+def _post(endpoint):
+    return _RouteTarget(endpoint, methods=frozenset(('POST',)))
+
+
+# URL parameters that take up an entire path segment are represented
+# as 1-tuples containing the parameter name
+_ARCH = ('arch',)
+
+
+def _service_routes():
+    arch = _ARCH
+    label = ('label',)
     return [
         # OCSP responder pattern
-        Rule('/<arch>/ocsp/<label>', endpoint='ocsp', methods=('POST',)),
+        ((arch, 'ocsp', label), _post('ocsp')),
+        # OCSP responder pattern for GET requests (RFC 5019)
+        ((arch, 'ocsp', label, _Remainder('encoded_req')), _get('ocsp-get')),
         # Time stamping service pattern
-        Rule('/<arch>/tsa/<label>', endpoint='tsa', methods=('POST',)),
+        ((arch, 'tsa', label), _post('tsa')),
         # Plugin endpoint pattern
-        Rule('/<arch>/plugin/<plugin_label>/<label>', endpoint='plugin',
-             methods=('POST',)),
+        ((arch, 'plugin', ('plugin_label',), label), _post('plugin')),
         # latest CRL pattern
-        Rule("/<arch>/crls/<label>/latest.<ext(exts='crl'):use_pem>",
-             endpoint='crls', methods=('GET',), defaults={'crl_no': None}),
+        ((arch, 'crls', label, _FileName('latest', exts=('crl',))),
+         _get('crls', crl_no=None)),
         # CRL archive pattern
-        Rule("/<arch>/crls/<label>"
-             "/archive-<int:crl_no>.<ext(exts='crl'):use_pem>",
-             endpoint='crls', methods=('GET',)),
+        ((arch, 'crls', label,
+          _FileName('archive-', 'crl_no', int_param=True, exts=('crl',))),
+         _get('crls')),
         # Cert repo authority pattern
-        Rule('/<arch>/certs/<label>/ca.<ext:use_pem>',
-             defaults={'cert_label': None}, endpoint='certs', methods=('GET',)),
+        ((arch, 'certs', label, _FileName('ca')),
+         _get('certs', cert_label=None)),
         # Cert repo generic pattern
-        Rule('/<arch>/certs/<label>/issued/<cert_label>.<ext:use_pem>',
-             endpoint='certs', methods=('GET',)),
+        ((arch, 'certs', label, 'issued', _FileName('', 'cert_label')),
+         _get('certs')),
         # Attr cert repo authority pattern
-        Rule('/<arch>/attr-certs/<label>/aa.<ext:use_pem>',
-             defaults={'cert_label': None},
-             endpoint='attr-certs', methods=('GET',)),
+        ((arch, 'attr-certs', label, _FileName('aa')),
+         _get('attr-certs', cert_label=None)),
         # Attr cert repo generic pattern
-        Rule("/<arch>/attr-certs/<label>/issued/<cert_label>.attr.<ext:use_pem>",
-             endpoint='attr-certs', methods=('GET',)),
-        Rule("/<arch>/attr-certs/<label>/by-holder/<entity_label>-all.attr.cert.pem",
-             endpoint='attr-certs-by-holder', methods=('GET',)),
+        ((arch, 'attr-certs', label, 'issued',
+          _FileName('', 'cert_label', suffix='.attr')),
+         _get('attr-certs')),
+        ((arch, 'attr-certs', label, 'by-holder',
+          _FileName('', 'entity_label', suffix='-all.attr.cert.pem', exts=())),
+         _get('attr-certs-by-holder')),
     ]
 
 
-def gen_index(architectures):
+def _web_ui_routes():
+    arch = _ARCH
+    prefix = WEB_UI_URL_PREFIX
+    return [
+        ((), _get('index')),
+        # convenience endpoint that serves certs without regard for
+        # checking whether they belong to any particular (logical)
+        # cert repo (these URLs aren't part of the "PKI API", for lack
+        # of a better term)
+        ((prefix, 'any-cert', arch, _FileName('', 'label')), _get('any-cert')),
+        ((prefix, 'any-attr-cert', arch,
+          _FileName('', 'label', suffix='.attr')),
+         _get('any-attr-cert')),
+        ((prefix, 'attr-certs-of', arch,
+          _FileName('', 'entity_label', suffix='-all.attr.cert.pem', exts=())),
+         _get('attr-certs-of')),
+        ((prefix, 'cert-bundle', arch), _get('cert-bundle')),
+        ((prefix, 'pfx-download', arch), _post('pfx-download')),
+    ]
+
+
+def _trie_step(node: dict, segment) -> dict:
+    if isinstance(segment, tuple):
+        param_name, child = node.setdefault(_PARAM, (segment[0], {}))
+        assert param_name == segment[0]
+        return child
+    return node.setdefault(segment, {})
+
+
+@functools.lru_cache(maxsize=None)
+def _build_routing_trie(with_web_ui: bool) -> dict:
+    """
+    Compile the URL schema into a trie keyed on path segments.
+
+    Literal segments are stored as ordinary keys. The ``_PARAM`` key
+    holds a ``(name, subtrie)`` pair for a segment that is captured as-is,
+    the ``_FILES`` key holds a list of ``(_FileName, _RouteTarget)`` pairs
+    for final segments, the ``_REST`` key holds a ``(name, _RouteTarget)``
+    pair for routes that capture the rest of the URL, and ``_TARGET``
+    marks a node where a route ends.
+    """
+    trie = {}
+    routes = _service_routes()
+    if with_web_ui:
+        routes += _web_ui_routes()
+    for segments, target in routes:
+        node = trie
+        if not segments:
+            node[_TARGET] = target
+            continue
+        for segment in segments[:-1]:
+            node = _trie_step(node, segment)
+        last = segments[-1]
+        if isinstance(last, _FileName):
+            node.setdefault(_FILES, []).append((last, target))
+        elif isinstance(last, _Remainder):
+            node[_REST] = (last.param, target)
+        else:
+            _trie_step(node, last)[_TARGET] = target
+    return trie
+
+
+def _match_route(trie: dict, segments: List[str], match_rest=True) \
+        -> Optional[Tuple[_RouteTarget, dict]]:
+    # Note: there's no backtracking. Where a literal segment competes with
+    # a parameter at the same level (e.g. the web UI prefix vs. the arch
+    # label at the root), the literal takes priority, like it did with
+    # werkzeug's router. Nodes that capture the remainder of the URL
+    # have no children.
+    node = trie
+    values = {}
+    last_ix = len(segments) - 1
+    for ix, segment in enumerate(segments):
+        try:
+            param_name, target = node[_REST]
+        except KeyError:
+            pass
+        else:
+            if not match_rest:
+                return None
+            remainder = '/'.join(segments[ix:])
+            if not remainder:
+                return None
+            values[param_name] = remainder
+            return target, values
+        if not segment:
+            return None
+        if ix == last_ix:
+            for file_name, target in node.get(_FILES, ()):
+                file_values = file_name.match(segment)
+                if file_values is not None:
+                    values.update(file_values)
+                    return target, values
+        try:
+            node = node[segment]
+            continue
+        except KeyError:
+            pass
+        try:
+            param_name, node = node[_PARAM]
+        except KeyError:
+            return None
+        values[param_name] = segment
+    try:
+        return node[_TARGET], values
+    except KeyError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _fixed_file_names() -> Tuple[str, ...]:
+    # all final segments in the schema that don't contain a parameter
+    names = []
+
+    def _collect(node):
+        for file_name, _ in node.get(_FILES, ()):
+            if file_name.param is None:
+                names.extend(
+                    file_name.prefix + suffix
+                    for suffix, _ in file_name._suffixes
+                )
+        for key, child in node.items():
+            if key is _PARAM:
+                _collect(child[1])
+            elif isinstance(key, str):
+                _collect(child)
+
+    _collect(_build_routing_trie(False))
+    return tuple(names)
+
+
+def _static_service_routes(pki_arch: PKIArchitecture) \
+        -> Dict[str, Tuple[str, FrozenSet[str], dict]]:
+    """
+    Resolve the URLs of all parameterless endpoints offered by the services
+    in a PKI architecture, so they can be dispatched with a single
+    dictionary lookup.
+
+    The values are ``(endpoint, methods, values)`` tuples. Routes that
+    capture the remainder of the URL are not included, since any fixed file
+    name would match them.
+    """
+    trie = _build_routing_trie(False)
+    routes = {}
+    for info in pki_arch.service_registry.list_all_services():
+        base = '/' + info.full_relative_url
+        candidates = itertools.chain(
+            (base,), (f"{base}/{name}" for name in _fixed_file_names())
+        )
+        for path in candidates:
+            match = _match_route(trie, path.split('/')[1:], match_rest=False)
+            if match is not None:
+                (endpoint, methods, defaults), values = match
+                values.update(defaults)
+                routes[path] = endpoint, methods, values
+    return routes
+
+
+@functools.lru_cache(maxsize=None)
+def _index_template():
     try:
         from jinja2 import Environment, PackageLoader
-    except ImportError as e:  # pragma: nocover
+    except ImportError as e:
         raise CertomancerServiceError(
             "Web UI requires Jinja2 to be installed"
         ) from e
 
-    # the index is fixed from the moment the server is launched, so
-    #  just go ahead and render it
     jinja_env = Environment(
         loader=PackageLoader('certomancer.integrations', 'animator_templates'),
         autoescape=True
     )
-    template = jinja_env.get_template('index.html')
-    return template.render(
+    return jinja_env.get_template('index.html')
+
+
+def gen_index(architectures):
+    # the index is fixed from the moment the server is launched, so
+    #  just go ahead and render it
+    return _index_template().render(
         pki_archs=[
             ArchServicesDescription.compile(arch) for arch in architectures
         ],
@@ -219,24 +501,83 @@ class AnimatorArchStore:
         return iter(self.architectures.values())
 
 
+# (MIME type, PEM armor type) to use, indexed by whether PEM was requested
+_CRL_FORMATS = {
+    True: ('application/x-pem-file', 'X509 CRL'),
+    False: ('application/pkix-crl', None),
+}
+_CERT_FORMATS = {
+    True: ('application/x-pem-file', 'certificate'),
+    False: ('application/pkix-cert', None),
+}
+_ATTR_CERT_FORMATS = {
+    True: ('application/x-pem-file', 'attribute certificate'),
+    False: ('application/pkix-attr-cert', None),
+}
+
+
+def _ocsp_max_age(resp: ocsp.OCSPResponse) -> Optional[int]:
+    # RFC 5019 says that a response shouldn't be cached beyond its nextUpdate
+    if resp['response_status'].native != 'successful':
+        return None
+    rdata = resp.basic_ocsp_response['tbs_response_data']
+    produced_at = rdata['produced_at'].native
+    next_updates = [r['next_update'].native for r in rdata['responses']]
+    if not next_updates or None in next_updates:
+        return None
+    return max(int((min(next_updates) - produced_at).total_seconds()), 0)
+
+
+def _der_digest(data: bytes) -> bytes:
+    # Two encodings of the same request only need to be compared for
+    # equality, so there's no point in parsing them first. Sixteen bytes of
+    # blake2b are plenty to avoid collisions between cache keys.
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _response_key(key: tuple, at_time: datetime, data: bytes) -> tuple:
+    return key + (at_time, _der_digest(data))
+
+
+def _passthrough_response(data: bytes, mimetype: str) -> Response:
+    # The payload is fully encoded already, so werkzeug doesn't need to wrap
+    # it in its own encoding iterator on the way out.
+    response = Response([data], mimetype=mimetype, direct_passthrough=True)
+    response.content_length = len(data)
+    return response
+
+
+# HTTP exceptions are stateless WSGI apps, so these can be shared between
+# requests
+_NOT_FOUND = NotFound()
+_INTERNAL_SERVER_ERROR = InternalServerError()
+
+
 class Animator:
 
     def __init__(self, architectures: AnimatorArchStore,
                  at_time: Optional[datetime] = None, with_web_ui=True,
-                 allow_time_override=True):
+                 allow_time_override=True,
+                 max_request_size: Optional[int] = DEFAULT_MAX_REQUEST_SIZE,
+                 response_cache_size: int = DEFAULT_RESPONSE_CACHE_SIZE):
         self.fixed_time = at_time
+        self.max_request_size = max_request_size
+        # looking up the local timezone isn't free, so do it only once
+        self._local_tz = tzlocal.get_localzone()
         self.architectures = architectures
         self.with_web_ui = with_web_ui
-        self.url_map = None
         self.allow_time_override = allow_time_override
+        # These are populated on demand, so that startup cost doesn't scale
+        # with the number of architectures & services being served.
+        self._static_routes = {}
+        self._routed_archs = set()
+        self._index_html = None
 
-        self.url_map = Map(
-            service_rules() + (web_ui_rules() if with_web_ui else []),
-            converters={'ext': PemExtensionConverter}
-        )
+        self._routing_trie = _build_routing_trie(bool(with_web_ui))
 
         handlers: Dict[str, Callable] = {
             'ocsp': self.serve_ocsp_response,
+            'ocsp-get': self.serve_ocsp_get_response,
             'tsa': self.serve_timestamp_response,
             'crls': self.serve_crl,
             'certs': self.serve_cert,
@@ -246,8 +587,11 @@ class Animator:
         }
 
         if with_web_ui:
-            self.index_html = gen_index(iter(architectures))
+            # Rendering the index is deferred until it's requested, but a
+            # missing Jinja2 should still be reported at startup.
+            _index_template()
             handlers.update({
+                'index': self.serve_index,
                 'any-cert': self.serve_any_cert,
                 'any-attr-cert': self.serve_any_attr_cert,
                 'attr-certs-of': self.serve_all_attr_certs_of_holder,
@@ -255,92 +599,222 @@ class Animator:
             })
 
         self._handlers = handlers
+        self._response_cache = _ResponseCache(response_cache_size)
 
-    def at_time(self, request):
+    def _fixed_time(self, request) -> Optional[datetime]:
         fake_time = None
         if self.allow_time_override:
             fake_time = request.headers.get(FAKE_TIME_HEADER, type=parse_dt)
 
-        return fake_time or self.fixed_time or _now()
+        return fake_time or self.fixed_time
 
-    def serve_ocsp_response(self, request: Request, *, label: str, arch: str):
+    def at_time(self, request):
+        return self._fixed_time(request) or self._now()
+
+    def _now(self):
+        return datetime.now(tz=self._local_tz)
+
+    def _read_request_body(self, request: Request) -> bytes:
+        limit = self.max_request_size
+        if limit is None:
+            return request.stream.read()
+        if request.content_length is not None \
+                and request.content_length > limit:
+            raise RequestEntityTooLarge()
+        # don't trust the content length (if any) to bound the read
+        data = request.stream.read(limit + 1)
+        if len(data) > limit:
+            raise RequestEntityTooLarge()
+        return data
+
+    def _cached_response(self, request: Request, key, data: bytes,
+                         build: Callable[[datetime], Any],
+                         size: Callable[[Any], int] = len):
+        # Responses are only reproducible if they're produced at a fixed
+        # point in time, so we don't bother caching anything else.
+        at_time = self._fixed_time(request)
+        if at_time is None:
+            return build(self._now())
+        return self._response_cache.get_or_compute(
+            _response_key(key, at_time, data), lambda: build(at_time),
+            size=size
+        )
+
+    def _ocsp_response(self, request: Request, *, label: str,
+                       arch: str, data: bytes) -> Tuple[bytes, Optional[int]]:
+        # Returns the encoded response together with its max-age, so that
+        # cache hits don't have to parse the response again.
         pki_arch = self.architectures[ArchLabel(arch)]
-        ocsp_resp = pki_arch.service_registry.summon_responder(
-            ServiceLabel(label), self.at_time(request)
+
+        def _build(at_time):
+            ocsp_resp = pki_arch.service_registry.summon_responder(
+                ServiceLabel(label), at_time
+            )
+            req: ocsp.OCSPRequest = ocsp.OCSPRequest.load(data)
+            resp = ocsp_resp.build_ocsp_response(req)
+            return resp.dump(), _ocsp_max_age(resp)
+
+        return self._cached_response(
+            request, ('ocsp', arch, label), data, _build,
+            size=lambda entry: len(entry[0])
+        )
+
+    def serve_ocsp_response(self, request: Request, *, label: str, arch: str):
+        data = self._read_request_body(request)
+        response, _ = self._ocsp_response(
+            request, label=label, arch=arch, data=data
+        )
+        return _passthrough_response(
+            response, mimetype='application/ocsp-response'
         )
-        data = request.stream.read()
-        req: ocsp.OCSPRequest = ocsp.OCSPRequest.load(data)
-        response = ocsp_resp.build_ocsp_response(req)
-        return Response(response.dump(), mimetype='application/ocsp-response')
+
+    def serve_ocsp_get_response(self, request: Request, *, label: str,
+                                arch: str, encoded_req: str):
+        # RFC 5019 prescribes the standard base64 alphabet, but we're lenient
+        # about the URL-safe alphabet and missing padding.
+        encoded_req = encoded_req.replace('-', '+').replace('_', '/')
+        encoded_req += '=' * (-len(encoded_req) % 4)
+        try:
+            data = base64.b64decode(encoded_req, validate=True)
+            # force a full parse, so malformed requests are rejected here
+            ocsp.OCSPRequest.load(data).native
+        except (ValueError, binascii.Error):
+            raise BadRequest()
+
+        # Responses are only reproducible at a fixed time, so that's the only
+        # case where we can hand out a (weak) ETag
+        etag = None
+        at_time = self._fixed_time(request)
+        if at_time is not None:
+            etag = _der_digest(
+                f"{arch}/{label}/{at_time.isoformat()}/".encode('utf8') + data
+            ).hex()
+
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            # RFC 7232 wants a 304 to carry the same caching headers as a 200
+            # would, but it's not worth signing a fresh response just to
+            # find out the max-age, so we only include it if we have the
+            # response cached.
+            cached = self._response_cache.get(
+                _response_key(('ocsp', arch, label), at_time, data)
+            )
+            max_age = cached[1] if cached is not None else None
+            response = Response(status=304)
+        else:
+            data, max_age = self._ocsp_response(
+                request, label=label, arch=arch, data=data
+            )
+            response = _passthrough_response(
+                data, mimetype='application/ocsp-response'
+            )
+        if self.allow_time_override:
+            # the response depends on the fake time header
+            response.vary.add(FAKE_TIME_HEADER)
+        if max_age is not None:
+            cache_control = response.cache_control
+            cache_control.max_age = max_age
+            cache_control.public = True
+            cache_control.no_transform = True
+            cache_control.must_revalidate = True
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response
 
     def serve_timestamp_response(self, request: Request, *,
                                  label: str, arch: str):
         pki_arch = self.architectures[ArchLabel(arch)]
-        tsa = pki_arch.service_registry.summon_timestamper(
-            ServiceLabel(label), self.at_time(request)
-        )
-        data = request.stream.read()
+        data = self._read_request_body(request)
         req: tsp.TimeStampReq = tsp.TimeStampReq.load(data)
-        response = tsa.request_tsa_response(req)
-        return Response(response.dump(), mimetype='application/timestamp-reply')
+
+        def _build(at_time):
+            tsa = pki_arch.service_registry.summon_timestamper(
+                ServiceLabel(label), at_time
+            )
+            return tsa.request_tsa_response(req).dump()
+
+        if req['nonce'].native is None:
+            # RFC 3161 requires every token to have a unique serial number,
+            # so we only replay tokens for requests that were resubmitted
+            # with the same nonce.
+            response = _build(self.at_time(request))
+        else:
+            response = self._cached_response(
+                request, ('tsa', arch, label), data, _build
+            )
+        return _passthrough_response(
+            response, mimetype='application/timestamp-reply'
+        )
+
+    def _dump_cached(self, key, dump: Callable[[], bytes],
+                     pem_type: Optional[str] = None) -> bytes:
+        # Only use this for objects that are fully determined by the key!
+        cache = self._response_cache
+
+        def _der():
+            return cache.get_or_compute(key, dump)
+
+        if pem_type is None:
+            return _der()
+        return cache.get_or_compute(
+            key + (pem_type,), lambda: pem.armor(pem_type, _der())
+        )
 
     def serve_crl(self, request: Request, *,
                   label: ServiceLabel, arch: str, crl_no, use_pem):
         pki_arch = self.architectures[ArchLabel(arch)]
-        mime = 'application/x-pem-file' if use_pem else 'application/pkix-crl'
-        if crl_no is not None:
-            crl = pki_arch.service_registry.get_crl(label, number=crl_no)
-        else:
-            crl = pki_arch.service_registry.get_crl(
-                label, self.at_time(request)
-            )
+        services = pki_arch.service_registry
+        mime, pem_type = _CRL_FORMATS[use_pem]
+        label = ServiceLabel(label)
+        if crl_no is None:
+            crl_no = services.get_crl_number(label, self.at_time(request))
 
-        data = crl.dump()
-        if use_pem:
-            data = pem.armor('X509 CRL', data)
-        return Response(data, mimetype=mime)
+        data = self._dump_cached(
+            ('crl', arch, label, crl_no),
+            lambda: services.get_crl(label, number=crl_no).dump(),
+            pem_type=pem_type
+        )
+        return _passthrough_response(data, mimetype=mime)
 
     def serve_any_cert(self, _request: Request, *,
                        arch: str, label: str, use_pem):
-        mime = 'application/x-pem-file' if use_pem else 'application/pkix-cert'
+        mime, pem_type = _CERT_FORMATS[use_pem]
         pki_arch = self.architectures[ArchLabel(arch)]
         cert = pki_arch.get_cert(CertLabel(label))
 
         data = cert.dump()
-        if use_pem:
-            data = pem.armor('certificate', data)
+        if pem_type is not None:
+            data = pem.armor(pem_type, data)
         return Response(data, mimetype=mime)
 
     def serve_any_attr_cert(self, _request: Request, *,
                             arch: str, label: str, use_pem):
-        mime = (
-            'application/x-pem-file'
-            if use_pem else 'application/pkix-attr-cert'
-        )
+        mime, pem_type = _ATTR_CERT_FORMATS[use_pem]
         pki_arch = self.architectures[ArchLabel(arch)]
         cert = pki_arch.get_attr_cert(CertLabel(label))
 
         data = cert.dump()
-        if use_pem:
-            data = pem.armor('attribute certificate', data)
+        if pem_type is not None:
+            data = pem.armor(pem_type, data)
         return Response(data, mimetype=mime)
 
     def serve_cert(self, _request: Request, *, label: str, arch: str,
                    cert_label: Optional[str], use_pem):
-        mime = 'application/x-pem-file' if use_pem else 'application/pkix-cert'
+        mime, pem_type = _CERT_FORMATS[use_pem]
         pki_arch = self.architectures[ArchLabel(arch)]
         cert_label = CertLabel(cert_label) if cert_label is not None else None
 
-        cert = pki_arch.service_registry.get_cert_from_repo(
-            ServiceLabel(label), cert_label
-        )
-        if cert is None:
-            raise NotFound()
+        def _dump():
+            cert = pki_arch.service_registry.get_cert_from_repo(
+                ServiceLabel(label), cert_label
+            )
+            if cert is None:
+                raise NotFound()
+            return cert.dump()
 
-        data = cert.dump()
-        if use_pem:
-            data = pem.armor('certificate', data)
-        return Response(data, mimetype=mime)
+        data = self._dump_cached(
+            ('cert', arch, label, cert_label), _dump, pem_type=pem_type
+        )
+        return _passthrough_response(data, mimetype=mime)
 
     def serve_attr_cert(self, _request: Request, *, label: str, arch: str,
                         cert_label: Optional[str], use_pem):
@@ -348,9 +822,7 @@ class Animator:
         svc_reg = pki_arch.service_registry
         svc_label = ServiceLabel(label)
         if cert_label is None:
-            mime = (
-                'application/x-pem-file' if use_pem else 'application/pkix-cert'
-            )
+            mime, pem_type = _CERT_FORMATS[use_pem]
             # retrieve the AA's certificate
             cert = pki_arch.get_cert(
                 svc_reg.determine_repo_issuer_cert(
@@ -358,10 +830,7 @@ class Animator:
                 )
             )
         else:
-            mime = (
-                'application/x-pem-file'
-                if use_pem else 'application/pkix-attr-cert'
-            )
+            mime, pem_type = _ATTR_CERT_FORMATS[use_pem]
             cert = svc_reg.get_attr_cert_from_repo(
                 svc_label, CertLabel(cert_label)
             )
@@ -369,12 +838,8 @@ class Animator:
             raise NotFound()
 
         data = cert.dump()
-        if use_pem:
-            data = pem.armor(
-                'attribute certificate'
-                if cert_label is not None else 'certificate',
-                data
-            )
+        if pem_type is not None:
+            data = pem.armor(pem_type, data)
         return Response(data, mimetype=mime)
 
     def _build_attr_cert_payload(self, pki_arch, cert_specs):
@@ -436,6 +901,9 @@ class Animator:
             raise BadRequest(e.user_msg)
         return Response(response_bytes, mimetype=content_type)
 
+    def serve_index(self, _request: Request):
+        return Response(self.index_html, mimetype='text/html')
+
     def serve_zip(self, _request: Request, *, arch):
         try:
             pki_arch = self.architectures[ArchLabel(arch)]
@@ -467,26 +935,62 @@ class Animator:
         return Response(data, mimetype='application/x-pkcs12',
                         headers={'Content-Disposition': cd_header})
 
+    @property
+    def index_html(self) -> str:
+        if self._index_html is None:
+            self._index_html = gen_index(iter(self.architectures))
+        return self._index_html
+
+    def _load_static_routes(self, arch: str) -> bool:
+        if arch in self._routed_archs:
+            return False
+        pki_arch = self.architectures[ArchLabel(arch)]
+        self._static_routes.update(_static_service_routes(pki_arch))
+        self._routed_archs.add(arch)
+        return True
+
+    def _match(self, request: Request):
+        path = request.path
+        static_route = self._static_routes.get(path)
+        if static_route is None:
+            segments = path.split('/')[1:] if path != '/' else []
+            if segments and segments[0] != WEB_UI_URL_PREFIX \
+                    and self._load_static_routes(segments[0]):
+                static_route = self._static_routes.get(path)
+
+        if static_route is None:
+            match = _match_route(self._routing_trie, segments)
+            if match is None:
+                raise NotFound()
+            (endpoint, methods, defaults), values = match
+            values.update(defaults)
+        else:
+            endpoint, methods, values = static_route
+        if request.method not in methods:
+            raise MethodNotAllowed(valid_methods=sorted(methods))
+        return endpoint, values
+
     def dispatch(self, request: Request):
-        adapter = self.url_map.bind_to_environ(request.environ)
-        # TODO even though this is a testing tool, inserting some safeguards
-        #  to check request size etc. might be prudent
         try:
-            endpoint, values = adapter.match()
+            endpoint, values = self._match(request)
             assert isinstance(endpoint, str)
-            if endpoint == 'index' and self.with_web_ui:
-                return Response(self.index_html, mimetype='text/html')
             handler = self._handlers[endpoint]
             return handler(request, **values)
         except CertomancerObjectNotFoundError as e:
             logger.info(e)
-            return NotFound()
+            return _NOT_FOUND
         except CertomancerServiceError as e:
             logger.error(e)
-            return InternalServerError()
+            return _INTERNAL_SERVER_ERROR
         except HTTPException as e:
             return e
 
+    def warm_up(self):
+        """
+        Get one-time setup costs out of the way before serving traffic.
+        """
+        _warm_up_asn1()
+
     def __call__(self, environ, start_response):
         request = Request(environ)
         resp = self.dispatch(request)
@@ -501,6 +1005,39 @@ def _check_env_flag(env, flag_name):
         return False
 
 
+def _warm_up_asn1():
+    # asn1crypto sets up the parsing metadata for a type the first time it's
+    # used
+    ocsp_req = ocsp.OCSPRequest({
+        'tbs_request': {
+            'request_list': [{
+                'req_cert': {
+                    'hash_algorithm': {'algorithm': 'sha1'},
+                    'issuer_name_hash': bytes(20),
+                    'issuer_key_hash': bytes(20),
+                    'serial_number': 1,
+                }
+            }],
+        }
+    })
+    tsp_req = tsp.TimeStampReq({
+        'version': 'v1',
+        'message_imprint': {
+            'hash_algorithm': {'algorithm': 'sha256'},
+            'hashed_message': bytes(32),
+        },
+    })
+    for req in (ocsp_req, tsp_req):
+        type(req).load(req.dump()).native
+
+
+def _get_env_int(env, var_name, default):
+    try:
+        return int(env[var_name])
+    except (KeyError, ValueError):
+        return default
+
+
 class LazyAnimator:
     def __init__(self):
         self.animator = None
@@ -517,6 +1054,9 @@ class LazyAnimator:
         allow_time_override = not _check_env_flag(
             env, 'CERTOMANCER_NO_TIME_OVERRIDE'
         )
+        response_cache_size = _get_env_int(
+            env, 'CERTOMANCER_RESPONSE_CACHE_SIZE', DEFAULT_RESPONSE_CACHE_SIZE
+        )
 
         cfg = CertomancerConfig.from_file(
             cfg_file, key_search_dir=key_dir, config_search_dir=config_dir,
@@ -524,12 +1064,23 @@ class LazyAnimator:
         )
         self.animator = Animator(
             AnimatorArchStore(cfg.pki_archs), with_web_ui=with_web_ui,
-            allow_time_override=allow_time_override
+            allow_time_override=allow_time_override,
+            response_cache_size=response_cache_size
         )
 
+    def preload(self):
+        """
+        Load the configuration and warm up the Animator ahead of the first
+        request, e.g. in a server's master process before it forks workers.
+        """
+        self._load()
+        self.animator.warm_up()
+
     def __call__(self, environ, start_response):
         self._load()
         return self.animator(environ, start_response)
 
 
 app = LazyAnimator()
+if _check_env_flag(os.environ, 'CERTOMANCER_PRELOAD'):
+    app.preload()
@@ -30,6 +30,7 @@ from .svc_config.cert_repo import (
 from .svc_config.crl import CRLRepoServiceInfo, CRLType
 from .svc_config.ocsp import OCSPResponderServiceInfo, OCSPInterface
 from .svc_config.tsa import TSAServiceInfo
+from .svc_config.api import ServiceInfo
 from ..config_utils import (
     ConfigurationError, check_config_keys,
     key_dashes_to_underscores,
@@ -963,6 +964,19 @@ class ServiceRegistry:
             for plugin_label, cfg in plugin_cfg.items()
         }
 
+    def list_all_services(self) -> List[ServiceInfo]:
+        """
+        List all services in the registry, including plugin services.
+        """
+        plugin_services = (
+            svcs.values() for svcs in self._plugin_services.values()
+        )
+        return list(itertools.chain(
+            self._ocsp.values(), self._tsa.values(), self._crl_repo.values(),
+            self._cert_repo.values(), self._attr_cert_repo.values(),
+            *plugin_services
+        ))
+
     def get_ocsp_info(self, label: ServiceLabel) -> OCSPResponderServiceInfo:
         try:
             return self._ocsp[label]
@@ -1069,39 +1083,58 @@ class ServiceRegistry:
             md_algorithm=info.digest_algo
         )
 
+    def _get_crl_issuer_cert(self, crl_info: CRLRepoServiceInfo) \
+            -> x509.Certificate:
+        # we need a cert to compute the right authority key identifier,
+        # time origin etc.
+        issuer_cert_label = crl_info.issuer_cert
+        if issuer_cert_label is None:
+            issuer_cert_label = crl_info.resolve_issuer_cert(self.pki_arch)
+        return self.pki_arch.get_cert(issuer_cert_label)
+
+    def get_crl_number(self, repo_label: ServiceLabel,
+                       at_time: Optional[datetime] = None) -> int:
+        """
+        Determine the number of the latest CRL published by a CRL repository
+        at the given time (or now, if no time is specified).
+        """
+        crl_info = self.get_crl_repo_info(repo_label)
+        time_origin = self._get_crl_issuer_cert(crl_info).not_valid_before
+        return self._compute_crl_number(crl_info, time_origin, at_time)
+
+    @staticmethod
+    def _compute_crl_number(crl_info: CRLRepoServiceInfo,
+                            time_origin: datetime,
+                            at_time: Optional[datetime]) -> int:
+        if at_time is None:
+            at_time = datetime.now(tz=tzlocal.get_localzone())
+        # work backwards to find a reasonable CRL number
+        elapsed = at_time - time_origin
+        if elapsed < timedelta(0):
+            raise CertomancerServiceError(
+                "CRL timestamp is before validity period of issuer cert; "
+                "could not deduce a reasonable CRL number. If you are "
+                "trying to create a questionable CRL on purpose, pass in a "
+                "CRL number manually."
+            )
+        return elapsed // crl_info.simulated_update_schedule
+
     def get_crl(self, repo_label: ServiceLabel,
                 at_time: Optional[datetime] = None,
                 number: Optional[int] = None):
         # TODO support indirect CRLs, delta CRLs, etc.?
 
         crl_info = self.get_crl_repo_info(repo_label)
-        issuer_cert_label = crl_info.issuer_cert
         signing_key_pair = \
             self.pki_arch.key_set.get_asym_key(crl_info.signing_key)
         signing_key = signing_key_pair.private
 
-        # we need a cert to compute the right authority key identifier,
-        # time origin etc.
-        if issuer_cert_label is None:
-            issuer_cert_label = crl_info.resolve_issuer_cert(self.pki_arch)
-        iss_cert = self.pki_arch.get_cert(issuer_cert_label)
-
+        iss_cert = self._get_crl_issuer_cert(crl_info)
         time_origin = iss_cert.not_valid_before
         time_delta = crl_info.simulated_update_schedule
 
         if number is None:
-            if at_time is None:
-                at_time = datetime.now(tz=tzlocal.get_localzone())
-            # work backwards to find a reasonable CRL number
-            elapsed = at_time - time_origin
-            if elapsed < timedelta(0):
-                raise CertomancerServiceError(
-                    "CRL timestamp is before validity period of issuer cert; "
-                    "could not deduce a reasonable CRL number. If you are "
-                    "trying to create a questionable CRL on purpose, pass in a "
-                    "CRL number manually."
-                )
-            number = elapsed // time_delta
+            number = self._compute_crl_number(crl_info, time_origin, at_time)
         this_update = time_origin + number * time_delta
         next_update = this_update + time_delta
 
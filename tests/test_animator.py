@@ -1,22 +1,27 @@
+import base64
 import hashlib
 import os
 from datetime import datetime
 from io import BytesIO
+from unittest import mock
+from urllib.parse import quote
 from zipfile import ZipFile
 
 import pytest
 import pytz
-from asn1crypto import tsp, algos, core, ocsp, cms, crl, x509
+from asn1crypto import tsp, algos, core, ocsp, cms, crl, x509, pem
 from freezegun import freeze_time
 from oscrypto import asymmetric, symmetric, keys as oskeys
 from werkzeug.test import Client
 from werkzeug.wrappers import Response
 
 from certomancer import CertomancerConfig
+from certomancer.integrations import animator as animator_module
 from certomancer.integrations.animator import (
     app, Animator, AnimatorArchStore, FAKE_TIME_HEADER
 )
-from certomancer.registry import KeyLabel, ArchLabel
+from certomancer.services import CertomancerServiceError
+from certomancer.registry import KeyLabel, ArchLabel, ServiceRegistry
 
 os.environ['CERTOMANCER_CONFIG'] = 'tests/data/with-services.yml'
 os.environ['CERTOMANCER_KEY_DIR'] = 'tests/data'
@@ -44,6 +49,52 @@ def test_timestamp():
            == datetime.now().replace(tzinfo=pytz.utc)
 
 
+def test_timestamp_cached_at_fixed_time():
+    req = tsp.TimeStampReq({
+        'version': 'v2',
+        'message_imprint': tsp.MessageImprint({
+            'hash_algorithm': algos.DigestAlgorithm({'algorithm': 'sha256'}),
+            'hashed_message': hashlib.sha256(b'test').digest()
+        }),
+        'nonce': core.Integer(0xdeadbeef),
+        'cert_req': True
+    })
+    headers = {FAKE_TIME_HEADER: '2020-11-01T00:00:00+0000'}
+    response1 = CLIENT.post(
+        "/testing-ca/tsa/tsa", data=req.dump(), headers=headers
+    )
+    response2 = CLIENT.post(
+        "/testing-ca/tsa/tsa", data=req.dump(), headers=headers
+    )
+    assert response1.content_length == len(response1.data)
+    # the TST serial number is random, so this can only be a cache hit
+    assert response1.data == response2.data
+
+
+def test_timestamp_without_nonce_not_cached():
+    req = tsp.TimeStampReq({
+        'version': 'v2',
+        'message_imprint': tsp.MessageImprint({
+            'hash_algorithm': algos.DigestAlgorithm({'algorithm': 'sha256'}),
+            'hashed_message': hashlib.sha256(b'test').digest()
+        }),
+        'cert_req': True
+    })
+    headers = {FAKE_TIME_HEADER: '2020-11-01T00:00:00+0000'}
+    response1 = CLIENT.post(
+        "/testing-ca/tsa/tsa", data=req.dump(), headers=headers
+    )
+    response2 = CLIENT.post(
+        "/testing-ca/tsa/tsa", data=req.dump(), headers=headers
+    )
+    serials = [
+        tsp.TimeStampResp.load(resp.data)['time_stamp_token']['content']
+        ['encap_content_info']['content'].parsed['serial_number'].native
+        for resp in (response1, response2)
+    ]
+    assert serials[0] != serials[1]
+
+
 @pytest.mark.parametrize(
     "time, expected", [
         ('2020-11-05', 'good'),
@@ -63,6 +114,238 @@ def test_ocsp(time, expected):
         assert status == expected
 
 
+def test_ocsp_response_cached_at_fixed_time():
+    with open('tests/data/signer2-ocsp-req.der', 'rb') as req_in:
+        req_data = req_in.read()
+    summon = ServiceRegistry.summon_responder
+    with mock.patch.object(ServiceRegistry, 'summon_responder',
+                           autospec=True, side_effect=summon) as summoned:
+        headers = {FAKE_TIME_HEADER: '2020-12-05T00:00:00+0000'}
+        response1 = CLIENT.post(
+            "/testing-ca/ocsp/interm", data=req_data, headers=headers
+        )
+        response2 = CLIENT.post(
+            "/testing-ca/ocsp/interm", data=req_data, headers=headers
+        )
+        assert summoned.call_count == 1
+        assert response1.data == response2.data
+
+        # no caching without a fixed time
+        CLIENT.post("/testing-ca/ocsp/interm", data=req_data)
+        CLIENT.post("/testing-ca/ocsp/interm", data=req_data)
+        assert summoned.call_count == 3
+
+
+@pytest.mark.parametrize('endpoint', ['/testing-ca/ocsp/interm',
+                                      '/testing-ca/tsa/tsa'])
+def test_request_too_large(endpoint):
+    response = CLIENT.post(endpoint, data=b'\x00' * (1024 * 1024))
+    assert response.status_code == 413
+
+
+def test_response_cache_disabled():
+    cfg = CertomancerConfig.from_file(
+        'tests/data/with-services.yml', 'tests/data'
+    )
+    no_cache_app = Animator(
+        AnimatorArchStore(cfg.pki_archs), response_cache_size=0,
+        at_time=datetime(2020, 12, 5, tzinfo=pytz.utc)
+    )
+    client = Client(no_cache_app, Response)
+    with open('tests/data/signer2-ocsp-req.der', 'rb') as req_in:
+        req_data = req_in.read()
+    summon = ServiceRegistry.summon_responder
+    with mock.patch.object(ServiceRegistry, 'summon_responder',
+                           autospec=True, side_effect=summon) as summoned:
+        client.post("/testing-ca/ocsp/interm", data=req_data)
+        client.post("/testing-ca/ocsp/interm", data=req_data)
+        assert summoned.call_count == 2
+
+
+def test_response_cache_bounded_by_size():
+    cache = animator_module._ResponseCache(maxsize=9)
+    cache.get_or_compute('a', lambda: b'1234')
+    cache.get_or_compute('b', lambda: b'5678')
+    # touch 'a', so 'b' is the one that gets evicted
+    assert cache.get('a') == b'1234'
+    cache.get_or_compute('c', lambda: b'90')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234' and cache.get('c') == b'90'
+    # oversized values are served, but never stored
+    cache.get_or_compute('d', lambda: bytes(10))
+    assert cache.get('d') is None
+    assert cache.get('a') == b'1234'
+
+
+def test_ocsp_get():
+    with open('tests/data/signer2-ocsp-req.der', 'rb') as req_in:
+        req_data = req_in.read()
+    url = '/testing-ca/ocsp/interm/' + quote(base64.b64encode(req_data))
+    headers = {FAKE_TIME_HEADER: '2020-12-05T00:00:00+0000'}
+    response = CLIENT.get(url, headers=headers)
+    assert response.status_code == 200
+    assert response.cache_control.max_age == 600
+    assert FAKE_TIME_HEADER in response.vary
+    resp = ocsp.OCSPResponse.load(response.data)
+    rdata = resp['response_bytes']['response'].parsed['tbs_response_data']
+    assert rdata['responses'][0]['cert_status'].name == 'revoked'
+
+    etag, weak = response.get_etag()
+    assert etag is not None and weak
+    response = CLIENT.get(
+        url, headers={**headers, 'If-None-Match': f'W/"{etag}"'}
+    )
+    assert response.status_code == 304
+    assert not response.data
+    assert response.cache_control.max_age == 600
+    assert response.cache_control.must_revalidate
+    assert FAKE_TIME_HEADER in response.vary
+
+    # no ETag against the live clock
+    response = CLIENT.get(url)
+    assert response.status_code == 200
+    assert response.get_etag() == (None, None)
+
+
+def test_static_routes_skip_ocsp_get():
+    cfg = CertomancerConfig.from_file(
+        'tests/data/with-services.yml', 'tests/data'
+    )
+    pki_arch = cfg.get_pki_arch(ArchLabel('testing-ca'))
+    routes = animator_module._static_service_routes(pki_arch)
+    assert '/testing-ca/certs/interm/ca.crt' in routes
+    assert not any(
+        endpoint == 'ocsp-get' for endpoint, _, _ in routes.values()
+    )
+
+
+def test_ocsp_get_not_modified_without_cache():
+    cfg = CertomancerConfig.from_file(
+        'tests/data/with-services.yml', 'tests/data'
+    )
+    client = Client(
+        Animator(AnimatorArchStore(cfg.pki_archs), response_cache_size=0),
+        Response
+    )
+    with open('tests/data/signer2-ocsp-req.der', 'rb') as req_in:
+        req_data = req_in.read()
+    url = '/testing-ca/ocsp/interm/' + quote(base64.b64encode(req_data))
+    headers = {FAKE_TIME_HEADER: '2020-12-05T00:00:00+0000'}
+    etag, _ = client.get(url, headers=headers).get_etag()
+    with mock.patch.object(ServiceRegistry, 'summon_responder') as summon:
+        response = client.get(
+            url, headers={**headers, 'If-None-Match': f'W/"{etag}"'}
+        )
+        assert response.status_code == 304
+        summon.assert_not_called()
+
+
+@pytest.mark.parametrize('encoded_req', [
+    'not*base64',
+    # valid base64, but not an OCSP request
+    base64.b64encode(b'garbage').decode('ascii'),
+])
+def test_ocsp_get_bad_encoding(encoded_req):
+    response = CLIENT.get('/testing-ca/ocsp/interm/' + quote(encoded_req))
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('path', [
+    '/', '/_certomancer/any-cert/testing-ca/interm.crt',
+    '/_certomancer/cert-bundle/testing-ca',
+])
+def test_web_ui_disabled(path):
+    cfg = CertomancerConfig.from_file(
+        'tests/data/with-services.yml', 'tests/data'
+    )
+    no_ui_app = Animator(AnimatorArchStore(cfg.pki_archs), with_web_ui=False)
+    client = Client(no_ui_app, Response)
+    assert client.get(path).status_code == 404
+    # check that the non-UI URLs still work
+    response = client.get('/testing-ca/certs/interm/ca.crt')
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('path, method, expected_status', [
+    ('/testing-ca/nonsense/interm', 'POST', 404),
+    ('/testing-ca/crls/interm/latest.crt', 'GET', 404),
+    ('/testing-ca/tsa/tsa', 'GET', 405),
+    ('/testing-ca/crls/interm/latest.crl', 'POST', 405),
+    ('/testing-ca', 'GET', 404),
+    ('/testing-ca/certs/nonexistent/ca.crt', 'GET', 404),
+    ('/testing-ca/crls/nonexistent/latest.crl', 'GET', 404),
+    ('/testing-ca/ocsp/interm/', 'POST', 404),
+    ('/testing-ca/crls/interm/archive-x.crl', 'GET', 404),
+    ('/testing-ca/certs/interm/issued/.crt', 'GET', 404),
+    ('/_certomancer/cert-bundle/testing-ca', 'POST', 405),
+    ('/_certomancer/any-cert/testing-ca/interm.pem', 'GET', 404),
+    ('/', 'POST', 405),
+])
+def test_routing_errors(path, method, expected_status):
+    response = CLIENT.open(path, method=method)
+    assert response.status_code == expected_status
+
+
+def test_lazy_setup():
+    cfg = CertomancerConfig.from_file(
+        'tests/data/with-services.yml', 'tests/data'
+    )
+    gen_index = animator_module.gen_index
+    static_routes = animator_module._static_service_routes
+    with mock.patch.object(animator_module, 'gen_index',
+                           side_effect=gen_index) as indexed, \
+            mock.patch.object(animator_module, '_static_service_routes',
+                              side_effect=static_routes) as routed:
+        client = Client(Animator(AnimatorArchStore(cfg.pki_archs)), Response)
+        assert indexed.call_count == routed.call_count == 0
+
+        for _ in range(2):
+            response = client.get('/testing-ca/certs/interm/ca.crt')
+            assert response.status_code == 200
+        assert routed.call_count == 1
+
+        for _ in range(2):
+            response = client.get('/')
+            assert b'testing-ca' in response.data
+        assert indexed.call_count == 1
+
+
+def test_lazy_animator_preload():
+    warm_up = animator_module._warm_up_asn1
+    with mock.patch.object(animator_module, '_warm_up_asn1',
+                           side_effect=warm_up) as warmed:
+        lazy_app = animator_module.LazyAnimator()
+        client = Client(lazy_app, Response)
+        response = client.get('/testing-ca/certs/interm/ca.crt')
+        assert response.status_code == 200
+        # serving a request doesn't count as warming up
+        assert warmed.call_count == 0
+
+        lazy_app = animator_module.LazyAnimator()
+        lazy_app.preload()
+        assert lazy_app.animator is not None
+        assert warmed.call_count == 1
+        client = Client(lazy_app, Response)
+        response = client.get('/testing-ca/certs/interm/ca.crt')
+        assert response.status_code == 200
+        assert warmed.call_count == 1
+
+
+def test_web_ui_requires_jinja2():
+    cfg = CertomancerConfig.from_file(
+        'tests/data/with-services.yml', 'tests/data'
+    )
+    animator_module._index_template.cache_clear()
+    try:
+        with mock.patch.dict('sys.modules', {'jinja2': None}):
+            with pytest.raises(CertomancerServiceError, match='Jinja2'):
+                Animator(AnimatorArchStore(cfg.pki_archs))
+            # no problem without the web UI
+            Animator(AnimatorArchStore(cfg.pki_archs), with_web_ui=False)
+    finally:
+        animator_module._index_template.cache_clear()
+
+
 def test_no_plugins_loaded():
     # make the endpoint encrypt something
     endpoint = '/testing-ca/plugin/encrypt-echo/test-endpoint'
@@ -149,6 +432,34 @@ def test_crl():
     assert invalidity_date == datetime(2020, 11, 30, tzinfo=pytz.utc)
 
 
+def test_crl_cached():
+    cfg = CertomancerConfig.from_file(
+        'tests/data/with-services.yml', 'tests/data'
+    )
+    client = Client(Animator(AnimatorArchStore(cfg.pki_archs)), Response)
+    get_crl = ServiceRegistry.get_crl
+    headers = {FAKE_TIME_HEADER: "2020-12-29T00:00:00+0000"}
+    with mock.patch.object(ServiceRegistry, 'get_crl',
+                           autospec=True, side_effect=get_crl) as built:
+        response1 = client.get(
+            '/testing-ca/crls/interm/latest.crl', headers=headers
+        )
+        response2 = client.get(
+            '/testing-ca/crls/interm/latest.crl.pem', headers=headers
+        )
+        assert built.call_count == 1
+    _, _, der = pem.unarmor(response2.data)
+    assert der == response1.data
+
+
+def test_crl_head():
+    response = CLIENT.head('/testing-ca/crls/interm/archive-1.crl')
+    assert response.status_code == 200
+    assert not response.data
+    full_response = CLIENT.get('/testing-ca/crls/interm/archive-1.crl')
+    assert response.content_length == len(full_response.data)
+
+
 def test_crl_archive():
     from tests.test_services import _check_crl_cardinality
     response = CLIENT.get('/testing-ca/crls/interm/archive-1.crl')
@@ -162,6 +473,27 @@ def test_crl_archive():
     )
 
 
+@pytest.mark.parametrize('path, expected_pem', [
+    ('/testing-ca/certs/root/issued/interm.crt', False),
+    ('/testing-ca/certs/root/issued/interm.cer', False),
+    ('/testing-ca/certs/root/issued/interm.cert.pem', True),
+    ('/testing-ca/certs/interm/ca.crt.pem', True),
+    ('/testing-ca/certs/interm/ca.cert', False),
+])
+def test_cert_repo_extensions(path, expected_pem):
+    response = CLIENT.get(path)
+    assert response.status_code == 200
+    data = response.data
+    if expected_pem:
+        assert response.mimetype == 'application/x-pem-file'
+        assert pem.detect(data)
+        _, _, data = pem.unarmor(data)
+    else:
+        assert response.mimetype == 'application/pkix-cert'
+    cert = x509.Certificate.load(data)
+    assert 'Intermediate' in cert.subject.human_friendly
+
+
 def test_cert_repo():
     response = CLIENT.get('/testing-ca/certs/root/issued/interm.crt')
     assert response.status_code == 200
@@ -175,6 +507,9 @@ def test_cert_repo():
     assert response.status_code == 200
     cert3 = x509.Certificate.load(response.data)
     assert cert1.dump() == cert2.dump() == cert3.dump()
+    response = CLIENT.get('/_certomancer/any-cert/testing-ca/interm.cer.pem')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-pem-file'
 
 
 def test_zip():
@@ -76,6 +76,14 @@ def test_crl(setup):
     assert invalidity_date == datetime(2020, 11, 30, tzinfo=pytz.utc)
 
 
+def test_crl_number():
+    services = RSA_SETUP.arch.service_registry
+    at_time = datetime.fromisoformat('2020-12-29 00:00:00+00:00')
+    number = services.get_crl_number(ServiceLabel('interm'), at_time)
+    some_crl = services.get_crl(ServiceLabel('interm'), at_time=at_time)
+    assert some_crl.crl_number_value.native == number
+
+
 def test_aa_crl():
 
     cfg = CertomancerConfig.from_file(
@@ -288,6 +296,24 @@ def test_demo_plugin(requests_mock):
     assert decrypted_payload == payload
 
 
+def test_list_all_services():
+    cfg = CertomancerConfig.from_file(
+        'tests/data/with-plugin.yml', 'tests/data'
+    )
+    services = cfg.get_pki_arch(ArchLabel('testing-ca')).service_registry
+    expected = [
+        *services.list_ocsp_responders(),
+        *services.list_time_stamping_services(),
+        *services.list_crl_repos(),
+        *services.list_cert_repos(),
+        *services.list_attr_cert_repos(),
+        *services.list_plugin_services(),
+    ]
+    all_services = services.list_all_services()
+    assert len(all_services) == len(expected)
+    assert set(map(id, all_services)) == set(map(id, expected))
+
+
 def test_svc_template_result():
     cfg = CertomancerConfig.from_file(
         'tests/data/with-services.yml', 'tests/data'